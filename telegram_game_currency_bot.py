@@ -1,19 +1,37 @@
 import os
-import json
+import atexit
+import asyncio
 import time
+import hmac
+import hashlib
+import secrets
 import logging
+import logging.handlers
 import sqlite3
-from uuid import uuid4
+from contextlib import contextmanager
+from queue import LifoQueue, SimpleQueue
 from typing import Dict, Any, Optional, Tuple
 
-import requests
+import httpx
+from aiohttp import web
+import orjson
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from aiogram.utils.callback_data import CallbackData
 
-logging.basicConfig(level=logging.INFO)
+# Handlers only enqueue records; a listener thread does the actual stream I/O
+_log_queue: SimpleQueue = SimpleQueue()
+# basicConfig gives the QueueHandler the format, so records arrive preformatted; don't format them twice
+log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+logging.getLogger("aiogram").setLevel(logging.WARNING)
+logging.getLogger("aiohttp").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 CRYPTO_PAY_API_TOKEN = os.getenv("CRYPTO_PAY_API_TOKEN", "")
@@ -24,6 +42,11 @@ if not CRYPTO_PAY_API_TOKEN:
     raise SystemExit("CRYPTO_PAY_API_TOKEN is not set")
 
 CRYPTO_PAY_BASE = "https://pay.crypt.bot/api"
+# When set, Crypto Pay pushes invoice_paid updates to /crypto_pay/webhook on this port
+CRYPTO_PAY_WEBHOOK_HOST = os.getenv("CRYPTO_PAY_WEBHOOK_HOST", "0.0.0.0")
+CRYPTO_PAY_WEBHOOK_PORT = os.getenv("CRYPTO_PAY_WEBHOOK_PORT", "")
+# How long check_payment trusts the local row before asking Crypto Pay directly
+CHECK_GRACE_SECONDS = int(os.getenv("CHECK_GRACE_SECONDS", "60")) if CRYPTO_PAY_WEBHOOK_PORT else 0
 
 bot = Bot(token=BOT_TOKEN, parse_mode=types.ParseMode.HTML)
 dp = Dispatcher(bot, storage=MemoryStorage())
@@ -32,73 +55,186 @@ DB_PATH = os.getenv("DB_PATH", "shop.db")
 
 ASSETS = ["USDT", "TON"]
 
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+START_TEXT = "👋 Привет! Выбери игру для покупки:"
+NICK_PROMPT = "Отправь игровой ник/ID для доставки заказа."
+ASSET_PROMPT = "Выбери крипто-актив для оплаты:"
+
+# Hot-path SQL kept as constants so each pooled connection's statement cache hits on the same text
+# Callbacks carry catalog row ids, not names: names may contain the CallbackData ':' separator
+SQL_GAMES = "SELECT game, MIN(id) FROM catalog GROUP BY game ORDER BY game"
+SQL_PACKAGES = (
+    "SELECT game, id, package, price_usdt FROM catalog "
+    "WHERE game=(SELECT game FROM catalog WHERE id=?) ORDER BY price_usdt"
+)
+SQL_ITEM = "SELECT game, package, price_usdt FROM catalog WHERE id=?"
+# Copies game/package/price from the live catalog row and inserts nothing if the item was removed or repriced
+SQL_INSERT_ORDER = (
+    "INSERT INTO orders (id, user_id, username, game, package, price_usdt, asset, nickname, created_at, status, invoice_id, pay_url) "
+    "SELECT ?, ?, ?, game, package, price_usdt, ?, ?, ?, ?, ?, ? FROM catalog WHERE id=? AND price_usdt=?"
+)
+SQL_MARK_PAID = "UPDATE orders SET status='paid' WHERE id=?"
+SQL_MARK_PAID_BY_INVOICE = "UPDATE orders SET status='paid' WHERE invoice_id=?"
+SQL_ORDER_STATUS = "SELECT status, created_at FROM orders WHERE id=?"
+
+class SQLitePool:
+    """Fixed set of long-lived connections, so SQLite keeps its page cache between queries."""
+
+    def __init__(self, path: str, size: int = 5):
+        self._q: "LifoQueue[sqlite3.Connection]" = LifoQueue(maxsize=size)
+        for _ in range(size):
+            self._q.put(self._open(path))
+
+    @staticmethod
+    def _open(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while the write lane commits
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=134217728")
+        conn.execute("PRAGMA cache_size=-16384")
+        return conn
+
+    @contextmanager
+    def acquire(self):
+        conn = self._q.get()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._q.put(conn)
+
+    def prepare(self, statements: Dict[str, Tuple[Any, ...]]):
+        """Run each statement once with dummy params on every connection to prime its statement cache."""
+        conns = [self._q.get() for _ in range(self._q.maxsize)]
+        try:
+            for conn in conns:
+                for sql, params in statements.items():
+                    try:
+                        conn.execute(sql, params)
+                    except sqlite3.Error:
+                        logging.exception("Failed to prepare statement: %s", sql)
+                    conn.rollback()
+        finally:
+            for conn in conns:
+                self._q.put(conn)
+
+# SQLite allows one writer at a time, so writes go through a single-connection lane
+write_pool = SQLitePool(DB_PATH, size=1)
+read_pool = SQLitePool(DB_PATH, size=int(os.getenv("DB_READ_POOL_SIZE", "4")))
 
 def init_db():
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS catalog (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            game TEXT NOT NULL,
-            package TEXT NOT NULL,
-            price_usdt REAL NOT NULL
+    with write_pool.acquire() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS catalog (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                game TEXT NOT NULL,
+                package TEXT NOT NULL,
+                price_usdt REAL NOT NULL
+            )
+            """
         )
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS orders (
-            id TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            username TEXT,
-            game TEXT NOT NULL,
-            package TEXT NOT NULL,
-            price_usdt REAL NOT NULL,
-            asset TEXT NOT NULL,
-            nickname TEXT NOT NULL,
-            created_at INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            invoice_id INTEGER,
-            pay_url TEXT
+        # covers both the games menu (DISTINCT game) and the per-game package list without a sort
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_catalog_game_price ON catalog(game, price_usdt, package)")
+        try:
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_catalog_game_package ON catalog(game, package)")
+        except sqlite3.IntegrityError:
+            # older databases may already hold duplicates; leave them for the operator rather than refuse to start
+            logging.exception("catalog has duplicate (game, package) rows; unique index not created")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                game TEXT NOT NULL,
+                package TEXT NOT NULL,
+                price_usdt REAL NOT NULL,
+                asset TEXT NOT NULL,
+                nickname TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                invoice_id INTEGER,
+                pay_url TEXT
+            )
+            """
         )
-        """
-    )
-    conn.commit()
-    conn.close()
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_invoice ON orders(invoice_id)")
+        conn.commit()
+
+def new_order_id() -> str:
+    """Millisecond timestamp then 24 random bits (19 hex chars), so inserts append to the PK index."""
+    return f"{int(time.time() * 1000):013x}{secrets.token_hex(3)}"
+
+def prepare_statements():
+    read_pool.prepare({SQL_GAMES: (), SQL_PACKAGES: (0,), SQL_ITEM: (0,), SQL_ORDER_STATUS: ("",)})
+    # writes are rolled back right after, so the dummy order never lands
+    write_pool.prepare({
+        SQL_INSERT_ORDER: ("", 0, None, "", "", 0, "", None, None, 0, 0.0),
+        SQL_MARK_PAID: ("",),
+        SQL_MARK_PAID_BY_INVOICE: (0,),
+    })
 
 def ensure_sample_catalog():
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as c FROM catalog")
-    if cur.fetchone()[0] == 0:
-        sample = [
-            ("Genshin Impact", "60 Genesis Crystals", 1.1),
-            ("Genshin Impact", "330 Genesis Crystals", 5.5),
-            ("World of Warcraft", "Gold 100k (EU)", 7.0),
-        ]
-        cur.executemany("INSERT INTO catalog(game, package, price_usdt) VALUES(?,?,?)", sample)
-        conn.commit()
-    conn.close()
+    sample = [
+        ("Genshin Impact", "60 Genesis Crystals", 1.1),
+        ("Genshin Impact", "330 Genesis Crystals", 5.5),
+        ("World of Warcraft", "Gold 100k (EU)", 7.0),
+    ]
+    # one statement, so the emptiness check and the insert are atomic; an operator-edited catalog is left alone
+    values = ",".join("(?,?,?)" for _ in sample)
+    with write_pool.acquire() as conn, conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO catalog(game, package, price_usdt) "
+            f"SELECT * FROM (VALUES {values}) WHERE NOT EXISTS (SELECT 1 FROM catalog)",
+            [v for row in sample for v in row],
+        )
+
+_cp_client: Optional[httpx.AsyncClient] = None
+
+# Only idempotent methods are retried; a retried createInvoice could bill twice
+CP_RETRY_METHODS = {"getInvoices"}
+CP_RETRY_STATUSES = {502, 503, 504}
+CP_RETRY_TOTAL = 3
+CP_RETRY_BACKOFF = 0.3
 
-def crypto_pay(method: str, payload: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
-    url = f"{CRYPTO_PAY_BASE}/{method}"
-    headers = {"Crypto-Pay-API-Token": CRYPTO_PAY_API_TOKEN, "Content-Type": "application/json"}
+async def open_crypto_pay_session():
+    global _cp_client
+    # HTTP/2 multiplexes concurrent createInvoice/getInvoices calls over one connection
+    _cp_client = httpx.AsyncClient(
+        http2=True,
+        base_url=CRYPTO_PAY_BASE,
+        headers={"Crypto-Pay-API-Token": CRYPTO_PAY_API_TOKEN, "Content-Type": "application/json"},
+        timeout=15,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=16, keepalive_expiry=60),
+    )
+
+async def close_crypto_pay_session():
+    if _cp_client is not None:
+        await _cp_client.aclose()
+
+async def crypto_pay(method: str, payload: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+    retries = CP_RETRY_TOTAL if method in CP_RETRY_METHODS else 0
     try:
-        r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        return bool(data.get("ok")), data
+        for attempt in range(retries + 1):
+            r = await _cp_client.post(f"/{method}", content=orjson.dumps(payload))
+            if r.status_code in CP_RETRY_STATUSES and attempt < retries:
+                await asyncio.sleep(CP_RETRY_BACKOFF * (2 ** attempt))
+                continue
+            r.raise_for_status()
+            data = orjson.loads(r.content)
+            return bool(data.get("ok")), data
     except Exception as e:
         logging.exception("Crypto Pay API error: %s", e)
         return False, {"error": str(e)}
 
-def create_invoice(asset: str, amount: float, description: str, payload: str) -> Optional[Dict[str, Any]]:
-    ok, data = crypto_pay(
+async def create_invoice(asset: str, amount: float, description: str, payload: str) -> Optional[Dict[str, Any]]:
+    ok, data = await crypto_pay(
         "createInvoice",
         {
             "asset": asset,
@@ -111,13 +247,127 @@ def create_invoice(asset: str, amount: float, description: str, payload: str) ->
         return data.get("result")
     return None
 
-def get_invoice(invoice_id: int) -> Optional[Dict[str, Any]]:
-    ok, data = crypto_pay("getInvoices", {"invoice_ids": [invoice_id]})
-    if ok:
-        arr = data.get("result", {}).get("items", [])
-        if arr:
-            return arr[0]
-    return None
+class InvoiceBatcher:
+    """Coalesces concurrent invoice lookups into one getInvoices call per window."""
+
+    def __init__(self, window: float = 0.2, max_batch: int = 50):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: Dict[int, asyncio.Future] = {}
+        self._event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def check(self, invoice_id: int) -> Optional[Dict[str, Any]]:
+        fut = self.pending.get(invoice_id)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self.pending[invoice_id] = fut
+            self._event.set()
+        # shield so one cancelled caller doesn't cancel the lookup for others on the same invoice
+        return await asyncio.shield(fut)
+
+    async def _flush_loop(self):
+        while True:
+            await self._event.wait()
+            await asyncio.sleep(self.window)
+            ids = list(self.pending)[:self.max_batch]
+            batch = {i: self.pending.pop(i) for i in ids}
+            if not self.pending:
+                self._event.clear()
+            items: Dict[int, Dict[str, Any]] = {}
+            try:
+                ok, data = await crypto_pay("getInvoices", {"invoice_ids": ids})
+                if ok:
+                    for item in data.get("result", {}).get("items", []):
+                        items[int(item["invoice_id"])] = item
+            except Exception as e:
+                logging.exception("Invoice batch lookup failed: %s", e)
+            for invoice_id, fut in batch.items():
+                if not fut.done():
+                    fut.set_result(items.get(invoice_id))
+
+batcher = InvoiceBatcher()
+
+def _fetch_item(catalog_id: int) -> Optional[Tuple[str, str, float]]:
+    with read_pool.acquire() as conn:
+        row = conn.execute(SQL_ITEM, (catalog_id,)).fetchone()
+    if not row:
+        return None
+    return row["game"], row["package"], float(row["price_usdt"])
+
+def _insert_order(order_id: str, user_id: int, username: Optional[str], catalog_id: int, price: float,
+                  asset: str, nickname: str, invoice_id: int, pay_url: str):
+    with write_pool.acquire() as conn, conn:
+        cur = conn.execute(SQL_INSERT_ORDER, (
+            order_id, user_id, username, asset, nickname, int(time.time()), "pending", invoice_id, pay_url,
+            catalog_id, price,
+        ))
+        if cur.rowcount == 0:
+            raise LookupError(f"catalog item {catalog_id} was removed or repriced before order {order_id} was stored")
+
+def _mark_paid(order_id: str):
+    with write_pool.acquire() as conn, conn:
+        conn.execute(SQL_MARK_PAID, (order_id,))
+
+def _mark_paid_by_invoice(invoice_id: int):
+    with write_pool.acquire() as conn, conn:
+        conn.execute(SQL_MARK_PAID_BY_INVOICE, (invoice_id,))
+
+def _fetch_order_status(order_id: str) -> Optional[sqlite3.Row]:
+    with read_pool.acquire() as conn:
+        return conn.execute(SQL_ORDER_STATUS, (order_id,)).fetchone()
+
+def valid_webhook_signature(body: bytes, signature: str) -> bool:
+    secret = hashlib.sha256(CRYPTO_PAY_API_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest().encode()
+    # compare bytes: compare_digest raises TypeError on non-ASCII str input
+    return hmac.compare_digest(expected, signature.encode())
+
+async def crypto_pay_webhook(request: web.Request) -> web.Response:
+    body = await request.read()
+    if not valid_webhook_signature(body, request.headers.get("crypto-pay-api-signature", "")):
+        return web.Response(status=401)
+    try:
+        update = orjson.loads(body)
+        paid_invoice_id = int(update["payload"]["invoice_id"]) if update.get("update_type") == "invoice_paid" else None
+    except (orjson.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError):
+        logging.warning("Malformed Crypto Pay webhook body: %r", body[:200])
+        return web.Response(status=400)
+    if paid_invoice_id is not None:
+        await asyncio.to_thread(_mark_paid_by_invoice, paid_invoice_id)
+    return web.Response(text="ok")
+
+_webhook_runner: Optional[web.AppRunner] = None
+
+async def start_webhook_server():
+    global _webhook_runner
+    if not CRYPTO_PAY_WEBHOOK_PORT:
+        return
+    app = web.Application()
+    app.router.add_post("/crypto_pay/webhook", crypto_pay_webhook)
+    _webhook_runner = web.AppRunner(app)
+    await _webhook_runner.setup()
+    await web.TCPSite(_webhook_runner, CRYPTO_PAY_WEBHOOK_HOST, int(CRYPTO_PAY_WEBHOOK_PORT)).start()
+
+async def stop_webhook_server():
+    if _webhook_runner is not None:
+        await _webhook_runner.cleanup()
+
+game_cb = CallbackData("game", "id")
+pkg_cb = CallbackData("pkg", "id")
+asset_cb = CallbackData("asset", "name")
+check_cb = CallbackData("check", "order_id", "invoice_id")
 
 class OrderFSM(StatesGroup):
     choosing_game = State()
@@ -125,111 +375,186 @@ class OrderFSM(StatesGroup):
     entering_nickname = State()
     choosing_asset = State()
 
+# Keyboards are cached per catalog version; bump_catalog_version() after any catalog write.
+# Edits made directly in the database show up in menus after a restart; prices charged are always read live.
+_catalog_version = 0
+_kb_cache: Dict[tuple, Any] = {}
+
+def bump_catalog_version():
+    global _catalog_version
+    _catalog_version += 1
+    _kb_cache.clear()
+
+def warm_kb_cache():
+    games_kb()
+    with read_pool.acquire() as conn:
+        game_ids = [game_id for _, game_id in conn.execute(SQL_GAMES)]
+    for game_id in game_ids:
+        packages_kb(game_id)
+
 def games_kb() -> InlineKeyboardMarkup:
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT DISTINCT game FROM catalog ORDER BY game")
-    kb = InlineKeyboardMarkup(row_width=2)
-    for (game,) in cur.fetchall():
-        kb.insert(InlineKeyboardButton(text=game, callback_data=f"game:{game}"))
-    conn.close()
+    key = ("games", _catalog_version)
+    kb = _kb_cache.get(key)
+    if kb is not None:
+        return kb
+    with read_pool.acquire() as conn:
+        rows = conn.execute(SQL_GAMES).fetchall()
+    buttons = [InlineKeyboardButton(text=game, callback_data=game_cb.new(id=game_id)) for game, game_id in rows]
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+    _kb_cache[key] = kb
     return kb
 
-def packages_kb(game: str) -> InlineKeyboardMarkup:
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT package, price_usdt FROM catalog WHERE game=? ORDER BY price_usdt", (game,))
-    kb = InlineKeyboardMarkup(row_width=1)
-    for pkg, price in cur.fetchall():
-        kb.add(InlineKeyboardButton(text=f"{pkg} — {price:.2f} USDT", callback_data=f"pkg:{pkg}"))
-    kb.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="back:games"))
-    conn.close()
-    return kb
+def packages_kb(game_id: int) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    """Game name and its package keyboard, or None if game_id is not in the catalog."""
+    key = ("pkgs", game_id, _catalog_version)
+    menu = _kb_cache.get(key)
+    if menu is not None:
+        return menu
+    with read_pool.acquire() as conn:
+        rows = conn.execute(SQL_PACKAGES, (game_id,)).fetchall()
+    # unknown ids come from stale or forged callbacks; don't let them grow the cache
+    if not rows:
+        return None
+    keyboard = [
+        [InlineKeyboardButton(text=f"{pkg} — {price:.2f} USDT", callback_data=pkg_cb.new(id=item_id))]
+        for _, item_id, pkg, price in rows
+    ]
+    keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="back:games")])
+    menu = (rows[0]["game"], InlineKeyboardMarkup(inline_keyboard=keyboard))
+    _kb_cache[key] = menu
+    return menu
+
+# Handlers take the cache hit inline and only push a miss (a DB query) off the event loop
+async def get_games_kb() -> InlineKeyboardMarkup:
+    kb = _kb_cache.get(("games", _catalog_version))
+    return kb if kb is not None else await asyncio.to_thread(games_kb)
+
+async def get_packages_menu(game_id: int) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    menu = _kb_cache.get(("pkgs", game_id, _catalog_version))
+    return menu if menu is not None else await asyncio.to_thread(packages_kb, game_id)
+
+_asset_buttons = [InlineKeyboardButton(text=a, callback_data=asset_cb.new(name=a)) for a in ASSETS]
+_ASSETS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    *(_asset_buttons[i:i + 2] for i in range(0, len(_asset_buttons), 2)),
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="back:packages")],
+])
 
 def assets_kb() -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup(row_width=2)
-    for a in ASSETS:
-        kb.insert(InlineKeyboardButton(text=a, callback_data=f"asset:{a}"))
-    kb.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="back:packages"))
-    return kb
+    return _ASSETS_KB
 
 def pay_kb(pay_url: str, order_id: str, invoice_id: int) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup(row_width=1)
-    kb.add(InlineKeyboardButton("💳 Оплатить (Crypto Pay)", url=pay_url))
-    kb.add(InlineKeyboardButton("✅ Я оплатил(а)", callback_data=f"check:{order_id}:{invoice_id}"))
-    return kb
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton("💳 Оплатить (Crypto Pay)", url=pay_url)],
+        [InlineKeyboardButton("✅ Я оплатил(а)", callback_data=check_cb.new(order_id=order_id, invoice_id=invoice_id))],
+    ])
 
 @dp.message_handler(commands=["start"])
 async def cmd_start(m: types.Message, state: FSMContext):
     await state.finish()
-    text = "👋 Привет! Выбери игру для покупки:"
-    await m.answer(text, reply_markup=games_kb())
+    await m.answer(START_TEXT, reply_markup=await get_games_kb())
 
-@dp.callback_query_handler(lambda c: c.data.startswith("game:"), state="*")
-async def pick_game(c: types.CallbackQuery, state: FSMContext):
-    game = c.data.split(":", 1)[1]
+@dp.callback_query_handler(game_cb.filter(), state="*")
+async def pick_game(c: types.CallbackQuery, callback_data: Dict[str, str], state: FSMContext):
+    menu = await get_packages_menu(int(callback_data["id"]))
+    if menu is None:
+        await c.answer("Игра не найдена", show_alert=True)
+        return
+    game, kb = menu
     await state.update_data(game=game)
     await OrderFSM.choosing_package.set()
-    await c.message.edit_text(f"Игра: <b>{game}</b>\nВыбери набор:", reply_markup=packages_kb(game))
+    await c.message.edit_text(f"Игра: <b>{game}</b>\nВыбери набор:", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("pkg:"), state=OrderFSM.choosing_package)
-async def pick_package(c: types.CallbackQuery, state: FSMContext):
-    pkg = c.data.split(":", 1)[1]
-    await state.update_data(package=pkg)
+@dp.callback_query_handler(pkg_cb.filter(), state=OrderFSM.choosing_package)
+async def pick_package(c: types.CallbackQuery, callback_data: Dict[str, str], state: FSMContext):
+    await state.update_data(catalog_id=int(callback_data["id"]))
     await OrderFSM.entering_nickname.set()
-    await c.message.edit_text("Отправь игровой ник/ID для доставки заказа.")
+    await c.message.edit_text(NICK_PROMPT)
 
 @dp.message_handler(lambda m: m.text and len(m.text) > 1, state=OrderFSM.entering_nickname)
 async def got_nickname(m: types.Message, state: FSMContext):
     nick = m.text.strip()
     await state.update_data(nickname=nick)
     await OrderFSM.choosing_asset.set()
-    await m.answer("Выбери крипто-актив для оплаты:", reply_markup=assets_kb())
+    await m.answer(ASSET_PROMPT, reply_markup=assets_kb())
 
-@dp.callback_query_handler(lambda c: c.data.startswith("asset:"), state=OrderFSM.choosing_asset)
-async def choose_asset(c: types.CallbackQuery, state: FSMContext):
-    asset = c.data.split(":", 1)[1]
+@dp.callback_query_handler(asset_cb.filter(), state=OrderFSM.choosing_asset)
+async def choose_asset(c: types.CallbackQuery, callback_data: Dict[str, str], state: FSMContext):
+    asset = callback_data["name"]
     data = await state.get_data()
-    game, pkg, nick = data["game"], data["package"], data["nickname"]
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT price_usdt FROM catalog WHERE game=? AND package=?", (game, pkg))
-    row = cur.fetchone(); conn.close()
-    if not row:
+    catalog_id, nick = data["catalog_id"], data["nickname"]
+    # the amount charged comes from the live row, never from the menu cache
+    item = await asyncio.to_thread(_fetch_item, catalog_id)
+    if item is None:
         await c.answer("Ошибка прайса", show_alert=True)
         await state.finish(); return
-    price = float(row[0])
-    order_id = uuid4().hex[:12]
+    game, pkg, price = item
+    order_id = new_order_id()
     desc = f"{game} - {pkg} (nick: {nick})"
-    invoice = create_invoice(asset=asset, amount=price, description=desc, payload=order_id)
+    invoice = await create_invoice(asset=asset, amount=price, description=desc, payload=order_id)
     if not invoice:
         await c.answer("Не удалось создать счёт", show_alert=True)
         return
     pay_url = invoice.get("pay_url"); invoice_id = int(invoice.get("invoice_id"))
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO orders VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",
-        (order_id, c.from_user.id, c.from_user.username, game, pkg, price, asset, nick, int(time.time()), "pending", invoice_id, pay_url))
-    conn.commit(); conn.close()
     text = f"<b>Заказ #{order_id}</b>\nИгра: {game}\nНабор: {pkg}\nНик: {nick}\nК оплате: {price} {asset}"
-    await c.message.edit_text(text, reply_markup=pay_kb(pay_url, order_id, invoice_id))
+    # the order insert and the Telegram edit are independent, so overlap them
+    edited, inserted = await asyncio.gather(
+        c.message.edit_text(text, reply_markup=pay_kb(pay_url, order_id, invoice_id)),
+        asyncio.to_thread(_insert_order,
+            order_id, c.from_user.id, c.from_user.username, catalog_id, price, asset, nick, invoice_id, pay_url),
+        return_exceptions=True,
+    )
     await state.finish()
+    if isinstance(inserted, Exception):
+        # the user may already see the pay link; withdraw the invoice so nobody pays for an unrecorded order
+        logging.error("Failed to store order %s: %s", order_id, inserted, exc_info=inserted)
+        await crypto_pay("deleteInvoice", {"invoice_id": invoice_id})
+        await c.message.edit_text("Не удалось оформить заказ, попробуй ещё раз.")
+        return
+    if isinstance(edited, Exception):
+        raise edited
 
-@dp.callback_query_handler(lambda c: c.data.startswith("check:"))
-async def check_payment(c: types.CallbackQuery):
-    _, order_id, invoice_id = c.data.split(":")
-    inv = get_invoice(int(invoice_id))
+@dp.callback_query_handler(check_cb.filter())
+async def check_payment(c: types.CallbackQuery, callback_data: Dict[str, str]):
+    order_id, invoice_id = callback_data["order_id"], callback_data["invoice_id"]
+    order = await asyncio.to_thread(_fetch_order_status, order_id)
+    if order and order["status"] == "paid":
+        await c.message.edit_text(f"✅ Оплата получена! Заказ #{order_id} оплачен.")
+        return
+    # give the webhook a chance to land before falling back to polling Crypto Pay
+    if order and time.time() - order["created_at"] < CHECK_GRACE_SECONDS:
+        await c.answer("Платёж ещё не поступил.", show_alert=True)
+        return
+    inv = await batcher.check(int(invoice_id))
     if not inv:
         await c.answer("Ошибка проверки", show_alert=True)
         return
     status = inv.get("status")
     if status == "paid":
-        conn = db(); cur = conn.cursor()
-        cur.execute("UPDATE orders SET status='paid' WHERE id=?", (order_id,))
-        conn.commit(); conn.close()
+        await asyncio.to_thread(_mark_paid, order_id)
         await c.message.edit_text(f"✅ Оплата получена! Заказ #{order_id} оплачен.")
     elif status == "active":
         await c.answer("Платёж ещё не поступил.", show_alert=True)
     else:
         await c.message.edit_text("Счёт недействителен.")
 
+async def on_startup(_: Dispatcher):
+    await open_crypto_pay_session()
+    batcher.start()
+    await start_webhook_server()
+
+async def on_shutdown(_: Dispatcher):
+    await stop_webhook_server()
+    await batcher.stop()
+    await close_crypto_pay_session()
+
 if __name__ == "__main__":
     init_db()
     ensure_sample_catalog()
-    executor.start_polling(dp, skip_updates=True)
+    prepare_statements()
+    warm_kb_cache()
+    executor.start_polling(
+        dp,
+        skip_updates=True,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+    )